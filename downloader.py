@@ -3,29 +3,63 @@ from the website ibdocuments.com.
 
 Only past year papers later than 2016 can be downloaded due to
 the naming conventions used.
+
+Run with --profile REPORT_DIR to write a profile of each stage of the
+download to REPORT_DIR (see profiler.py).
+
+Run with --bundle PATH (e.g. papers.zip or papers.tar.gz) to write the
+papers straight into an archive instead of the LEVEL/YEAR/MONTH folders.
+Add --per session for one archive per examination session.
 """
 
 # Standard library modules
+import argparse
 import os
 
 # Local modules
 import helpers
+import profiler
 
 
 FILE_PATH = os.path.abspath(".")
 ROOT_DIR = FILE_PATH
 INPUT_PATH = os.path.join(FILE_PATH, 'input.csv')
 
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--profile', metavar='REPORT_DIR',
+                    help='profile each stage and write a report to REPORT_DIR')
+parser.add_argument('--bundle', metavar='PATH',
+                    help='write the papers into a ZIP or tar archive at PATH')
+parser.add_argument('--per', choices=['selection', 'session'],
+                    default='selection',
+                    help='one archive for all papers or one per session')
+args = parser.parse_args()
+
+if args.profile:
+    profiler.enable(args.profile)
+
 # Get list of papers in dict form from csv file
 papers = helpers.csv2dict(INPUT_PATH)
 
+bundle = None
+if args.bundle:
+    bundle = helpers.PaperBundle(args.bundle, args.per)
+
 # Iterate over list of papers
-for paper in papers:
-    r,pname = helpers.getPYP(paper)
-    error = helpers.downloadPYP(r, pname, paper)
-    if error:
-        papername = helpers.paperNameGen(paper)
-        raise Exception("No such paper: {}".format(papername))
-    else:
-        helpers.renamePYP(paper, ROOT_DIR)
+try:
+    for paper in papers:
+        r,pname = helpers.getPYP(paper)
+        error = helpers.downloadPYP(r, pname, paper, bundle=bundle)
+        if error == 1:
+            papername = helpers.paperNameGen(paper)
+            raise Exception("No such paper: {}".format(papername))
+        elif bundle is None:
+            helpers.renamePYP(paper, ROOT_DIR)
+finally:
+    if bundle is not None:
+        bundle.close()
+
+    # Write the report even if a paper could not be found
+    if args.profile:
+        profiler.dump()
 
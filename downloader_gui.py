@@ -3,9 +3,11 @@
 
 """A GUI for downloader.py"""
 
+import argparse
 from functools import partial
 import os
 import sys
+import time
 
 import PyQt5.QtCore as qtCore
 import PyQt5.QtWidgets as qtWid
@@ -13,11 +15,17 @@ import PyQt5.QtGui as qtGUI
 from PyQt5.sip import delete
 
 import helpers
+import profiler
 
 # Path to the Python file
 FILE_PATH = os.path.abspath(".")
 # Path to where the past year papers will be stored
 ROOT_DIR = FILE_PATH
+# Name of the archive when papers are bundled, without extension.
+# The time of the download is added to it, e.g. Physics_PYP_20210520_143000
+BUNDLE_NAME = "Physics_PYP"
+# File extension of the archive for each output
+BUNDLE_EXTS = {"ZIP": ".zip", "tar.gz": ".tar.gz"}
 
 # Create the View 
 class DloaderUI(qtWid.QMainWindow):
@@ -53,6 +61,7 @@ class DloaderUI(qtWid.QMainWindow):
         self._createKindLayout()
         self._createTZLayout()
         self._createNumLayout()
+        self._createOutputLayout()
         self.widgets['submit'] = qtWid.QPushButton('submit')
         self.widgets['message'] = qtWid.QLabel('')
         
@@ -94,6 +103,20 @@ class DloaderUI(qtWid.QMainWindow):
         self.rightLayout.addLayout(self.numLayout)
 
 
+    def _createOutputLayout(self):
+        self.outputLayout = qtWid.QFormLayout()
+        self.outputLayout.addRow(qtWid.QLabel("Output"))
+        outputItems = {
+            "Save as": ('output', ["Folders"] + list(BUNDLE_EXTS)),
+            "Bundle per": ('per', ["Selection", "Session"]),
+        }
+        for label, (key, items) in outputItems.items():
+            self.widgets[label] = [qtWid.QComboBox(), key]
+            self.widgets[label][0].addItems(items)
+            self.outputLayout.addRow(qtWid.QLabel(label), self.widgets[label][0])
+        self.rightLayout.addLayout(self.outputLayout)
+
+
     def _createTZLayout(self):
         self.tzLayout =  qtWid.QGridLayout()
         self.tzLayout.addWidget(qtWid.QLabel("Timezone"), 0, 0, 1, 2)
@@ -122,7 +145,8 @@ class DloaderCtrller:
         self._view = view
         self._model = model
         self._connectSignals()
-        self.params = {'yearFrom':'2016', 'yearTo':'2016'}
+        self.params = {'yearFrom':'2016', 'yearTo':'2016',
+                       'output':'Folders', 'per':'Selection'}
 
 
     def _addParam(self, widget, key):
@@ -215,6 +239,16 @@ class DloaderCtrller:
                             papers.append(paper)
         
         self.papers = papers
+
+        # Write the papers straight into an archive if requested.
+        # Each download gets its own archive, so earlier ones are kept.
+        self.bundle = None
+        ext = BUNDLE_EXTS.get(self.params.get("output"))
+        if ext is not None:
+            name = BUNDLE_NAME + time.strftime("_%Y%m%d_%H%M%S")
+            path = os.path.join(ROOT_DIR, name + ext)
+            self.bundle = helpers.PaperBundle(path, self.params["per"].lower())
+
         self._model(self)
 
     
@@ -241,7 +275,8 @@ def downloadPaper(controller):
     """Downloader_GUI's Model"""
 
     controller.thread = qtCore.QThread()
-    controller.worker = Worker(controller.papers, controller._view)
+    controller.worker = Worker(controller.papers, controller._view,
+                               controller.bundle)
     controller.worker.moveToThread(controller.thread)
     controller.thread.started.connect(controller.worker.run)
     controller.worker.finished.connect(controller.thread.quit)
@@ -270,10 +305,11 @@ class Worker(qtCore.QObject):
     finished = qtCore.pyqtSignal(dict)
     progress = qtCore.pyqtSignal(int, int, str)
 
-    def __init__(self, papers, view):
+    def __init__(self, papers, view, bundle=None):
         super().__init__()
         self.papers = papers
         self.view = view
+        self.bundle = bundle
 
     def run(self):
         self.downloadPaper(self.papers, self.view)
@@ -283,33 +319,55 @@ class Worker(qtCore.QObject):
         status = {}
         
         # Iterate over list of papers to download and rename them
-        for i, paper in enumerate(papers):
-            N = len(papers)
-            r,pname = helpers.getPYP(paper)
-            error = helpers.downloadPYP(r, pname, paper)
-            papername = helpers.paperNameGen(paper)
-            if error:
-                status_message = "Not found"
-                
-            else: 
-                error = helpers.renamePYP(paper, ROOT_DIR)
-                if error:
+        try:
+            for i, paper in enumerate(papers):
+                N = len(papers)
+                r,pname = helpers.getPYP(paper)
+                error = helpers.downloadPYP(r, pname, paper, bundle=self.bundle)
+                papername = helpers.paperNameGen(paper)
+                if error == 1:
+                    status_message = "Not found"
+
+                elif error == 2:
                     status_message = "File already exists"
-                else:
-                    status_message = "Downloaded"
 
-            message = status_message + ': ' + papername
+                elif self.bundle is not None:
+                    status_message = "Bundled"
+
+                else: 
+                    error = helpers.renamePYP(paper, ROOT_DIR)
+                    if error:
+                        status_message = "File already exists"
+                    else:
+                        status_message = "Downloaded"
+
+                message = status_message + ': ' + papername
 
-            self.progress.emit(i+1, N, message)
-            status[papername] = status_message
-            
+                with profiler.stage("signals"):
+                    self.progress.emit(i+1, N, message)
+                status[papername] = status_message
+        finally:
+            # Finish writing the archives, even if a download failed,
+            # so that they can still be opened
+            if self.bundle is not None:
+                for path in self.bundle.close():
+                    status[os.path.basename(path)] = "Written"
 
-        self.finished.emit(status)
+        with profiler.stage("signals"):
+            self.finished.emit(status)
 
 
 def main():
     """Main function"""
-    app = qtWid.QApplication(sys.argv)
+    # Options not known here are left for Qt
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', metavar='REPORT_DIR',
+                        help='profile each stage and write a report to REPORT_DIR')
+    args, qtArgs = parser.parse_known_args()
+    if args.profile:
+        profiler.enable(args.profile)
+
+    app = qtWid.QApplication(sys.argv[:1] + qtArgs)
     app.setStyle('windowsvista')
     custom_font = qtGUI.QFont('Arial font')
     custom_font.setWeight(20)
@@ -326,7 +384,10 @@ def main():
     model = downloadPaper
     DloaderCtrller(model=model, view=view)
     # Execute main loop
-    sys.exit(app.exec_())
+    code = app.exec_()
+    if args.profile:
+        profiler.dump()
+    sys.exit(code)
 
 
 if __name__ == "__main__":
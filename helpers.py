@@ -2,14 +2,215 @@
 
 
 # Standard library modules
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import csv
+import io
+import json
 import os
 import os.path
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 
 # Third party modules
 import requests
 
+# Local modules
+import profiler
+
+
+# Root of the past year papers on the website
+URL_ROOT = "https://www.ibdocuments.com/IB%20PAST%20PAPERS%20-%20YEAR/"
+
+# Known folder layouts used by the website for each examination session.
+# {year} is the year in full, {month} is e.g. May or Nov and
+# {fullmonth} is e.g. May or November.
+URL_LAYOUTS = {
+    "sciences": ("{year}%20Examination%20Session/{fullmonth}%20{year}"
+                 "%20Examination%20Session/Experimental%20sciences/"),
+    "group4": ("{year}%20Examination%20Session/{fullmonth}%20{year}"
+               "%20Examination%20Session/Group%204%20-%20Experimental%20Sciences/"),
+    "Sciences": ("{year}%20Examination%20Session/{fullmonth}%20{year}"
+                 "%20Examination%20Session/Experimental%20Sciences/"),
+    "short-month": ("{year}%20Examination%20Session/{month}%20{year}"
+                    "%20Examination%20Session/Experimental%20sciences/"),
+}
+
+# File to remember which layout worked for each examination session.
+# It is kept in the working directory, where the papers are stored, as the
+# folder of this file is temporary in the executables.
+LAYOUT_FILE = os.path.join(os.path.abspath("."), "layouts.json")
+
+# Seconds to wait for a candidate url to answer before also trying the next one
+HEDGE_DELAY = 0.5
+
+# Layouts learned so far, loaded from LAYOUT_FILE on first use
+_layouts = None
+_layouts_lock = threading.Lock()
+
+# Bytes written to a bundle at a time
+CHUNK_SIZE = 64 * 1024
+
+# Papers bigger than this are spooled to a temporary file for tar bundles
+SPOOL_SIZE = 32 * 1024 * 1024
+
+# Archive formats of bundles, by file extension
+BUNDLE_FORMATS = {
+    ".zip": "zip",
+    ".tar": "w",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tar.xz": "w:xz",
+}
+
+
+class PaperBundle:
+    """Writes downloaded past year papers straight into ZIP or tar archives
+
+    Papers are stored in the archive in the same LEVEL/YEAR/MONTH folders
+    as renamePYP, instead of saving them in the folders first. ZIP entries are
+    streamed from the web request as the paper arrives. Tar entries need
+    their size up front, so each paper is received in memory first (or in
+    a temporary file if bigger than SPOOL_SIZE).
+
+    Papers may be added from several threads at once. Papers for the same
+    archive are written one at a time, papers for different archives
+    (see per) at the same time.
 
+    Args:
+        path: the archive to write, e.g. papers.zip or papers.tar.gz.
+              Existing archives are overwritten.
+        per(str): "selection" for one archive of all papers, or "session"
+                  for one archive per examination session, named e.g.
+                  papers_2021_MAY.zip
+    """
+
+    def __init__(self, path, per="selection"):
+        if per not in ["selection", "session"]:
+            raise Exception("Format error: per must be selection or session")
+
+        for ext, mode in BUNDLE_FORMATS.items():
+            if path.lower().endswith(ext):
+                break
+        else:
+            raise Exception("Format error: bundle must be one of "
+                            + ", ".join(BUNDLE_FORMATS))
+
+        self.root = path[:len(path) - len(ext)]
+        self.ext = ext
+        self.mode = mode
+        self.per = per
+        self.archives = {}  # open archives by file path
+        self.names = {}  # entries written to each archive
+        self.locks = {}  # lock of each archive
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, paper, r):
+        """Writes a downloaded paper to its archive
+
+        Args:
+            paper(dict): paper details
+            r(web request): the web request of the paper
+
+        Returns:
+            int: 0 if written, 1 if the paper is already in the archive
+        """
+
+        if self.per == "session":
+            path = (self.root + "_" + paper["year"] + "_"
+                    + paper["month"].upper() + self.ext)
+        else:
+            path = self.root + self.ext
+        name = paperPathGen(paper)
+
+        with self._lock:
+            # Reopening an archive would overwrite it
+            if self.closed:
+                raise Exception("Bundle error: bundle is already closed")
+
+            if path not in self.archives:
+                if self.mode == "zip":
+                    archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+                else:
+                    archive = tarfile.open(path, self.mode)
+                self.archives[path] = archive
+                self.names[path] = set()
+                self.locks[path] = threading.Lock()
+            archive = self.archives[path]
+
+            # File exists. Cannot override
+            if name in self.names[path]:
+                return 1
+            self.names[path].add(name)
+
+        try:
+            if self.mode == "zip":
+                with self.locks[path]:
+                    info = zipfile.ZipInfo(name, time.localtime()[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with archive.open(info, "w", force_zip64=True) as entry:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            entry.write(chunk)
+            else:
+                # The tar header holds the size of the paper, so the paper
+                # is received in full before the header is written. A failed
+                # download then leaves no broken entry in the archive.
+                with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        spool.write(chunk)
+                    size = r.headers.get("Content-Length")
+                    if (size is not None and "Content-Encoding" not in r.headers
+                            and int(size) != spool.tell()):
+                        raise Exception("Download error: incomplete paper: "
+                                        + name)
+
+                    info = tarfile.TarInfo(name)
+                    info.mtime = time.time()
+                    info.size = spool.tell()
+                    spool.seek(0)
+                    with self.locks[path]:
+                        archive.addfile(info, spool)
+        except BaseException:
+            # Let the paper be added again later
+            with self._lock:
+                self.names[path].discard(name)
+            raise
+        return 0
+
+    def close(self):
+        """Finishes writing all archives
+
+        Returns:
+            list: the paths of the archives written
+        """
+
+        with self._lock:
+            self.closed = True
+            paths = list(self.archives)
+            for path in paths:
+                with self.locks[path]:
+                    self.archives[path].close()
+            self.archives = {}
+        return paths
+
+
+def _closeResponse(future):
+    """Closes the web request of a finished future, if any"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+@profiler.profiled("csv2dict")
 def csv2dict(filename):
     """Converts contents in a CSV file to a list of dictionaries.
 
@@ -58,7 +259,7 @@ def csv2dict(filename):
     return papers
 
 
-def downloadPYP(r, pname, paper, path=None):
+def downloadPYP(r, pname, paper, path=None, bundle=None):
     """Download past year paper from web request
     
     Args:
@@ -66,23 +267,39 @@ def downloadPYP(r, pname, paper, path=None):
         pname(str): the name of the paper downloaded from the website
         paper(dict): this is necessary as the pname does not include much details
         path: the filepath to save the paper
+        bundle(PaperBundle): if given, the paper is written to the bundle
+                             instead of the filepath
         
     Returns:
-        error code(int)
+        error code(int): 1 if the paper cannot be found,
+                         2 if the paper is already in the bundle
     
     """
 
     # import os
     
     # Download if page can be found
-    if r.text.find('Error 404 - Page Not Found') == -1:
+    if pageFound(r):
+        # The paper is downloaded while it is written to the bundle,
+        # so both are profiled together
+        if bundle is not None:
+            with profiler.stage("bundle"):
+                if bundle.add(paper, r):
+                    return 2
+            return 0
+
         if path == None:
             # If path to store the paper is not specified,
             # use current working directory as the path
             path = os.getcwd()
 
         path = os.path.join(path, pname)
-        open(pname, "wb").write(r.content)
+
+        # Only the headers have been received so far
+        with profiler.stage("download"):
+            content = r.content
+        with profiler.stage("write"):
+            open(pname, "wb").write(content)
     
     # Raise error if page cannot be found.
     # Perhaps there is no such paper, or an error in the name
@@ -94,6 +311,7 @@ def downloadPYP(r, pname, paper, path=None):
     return 0
 
 
+@profiler.profiled("request")
 def getPYP(paper):
     """Extracts past year papers from ibdocuments.com
 
@@ -131,35 +349,167 @@ def getPYP(paper):
     # First letter of month must be capitalized when used in url
     paper["month"] = paper["month"].capitalize()
 
-    year = paper["year"]
-    month = paper["month"]
+    # Try the candidate urls, best guess first, and keep the first one found
+    urls = urlGen(paper, pname)
+    index, r = hedgedGet([url for layout, url in urls])
 
-    if paper['month'] == 'Nov':
-        month = 'November'
+    # Remember the layout that worked for this examination session
+    if index is not None:
+        learnLayout(paper, urls[index][0])
 
-    # Set up url
-    url0 = "https://www.ibdocuments.com/IB%20PAST%20PAPERS%20-%20YEAR/"
-    url = (url0 + year + "%20Examination%20Session/" + month + "%20"
-           + year + "%20Examination%20Session/Experimental%20sciences/"
-           + pname)
+    return r, pname
 
-    # For now, this year and month has an anomaly in the naming
-    if (month == 'May' and year == '2016'):
-        url = (url0 + year + "%20Examination%20Session/" + month + "%20"
-           + year + "%20Examination%20Session/Group%204%20-%20Experimental%20Sciences/"
-           + pname)
 
-    # Generate get-request to the website
+def hedgedGet(urls, delay=None):
+    """Requests candidate urls and keeps the first page found
+
+    The first url is requested straight away. If it has not answered
+    after delay seconds, the next url is also requested, and so on. A page
+    is found as soon as its headers arrive, so the body of the paper is
+    only read from the winning web request. Once a page is found, urls not
+    yet requested are cancelled and all other web requests are closed.
+
+    Args:
+        urls(list): candidate urls, best guess first
+        delay(float): seconds to wait before requesting the next url
+
+    Returns:
+        int, web request
+        The index is None if no page was found, in which case the last
+        web request received is returned.
+    """
+
+    if delay is None:
+        delay = HEDGE_DELAY
+
+    def probe(url):
+        # Only wait for the headers. The body is read by the caller.
+        return requests.get(url, stream=True)
+
+    executor = ThreadPoolExecutor(max_workers=len(urls))
+    futures = {}
+    pending = set()
+    responses = []
+    winner = None
+    error = None
     try:
-        r=requests.get(url)
-    except requests.HTTPError as e:
-        if e.response.status_code == 404:
-            return None
-        else:
-            raise
-    return r, pname
+        for i, url in enumerate(urls):
+            future = executor.submit(probe, url)
+            futures[future] = i
+            pending.add(future)
+
+            # Wait for the next url unless this is the last one
+            while pending and winner is None:
+                timeout = delay if i < len(urls) - 1 else None
+                done, pending = wait(pending, timeout=timeout,
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in sorted(done, key=futures.get):
+                    try:
+                        r = future.result()
+                        found = pageFound(r)
+                    except requests.RequestException as e:
+                        error = e
+                        continue
+                    if found and winner is None:
+                        winner = futures[future], r
+                    else:
+                        responses.append(r)
+                if i < len(urls) - 1:
+                    break
+            if winner is not None:
+                break
+    finally:
+        # Close responses still arriving from the other urls
+        for future in pending:
+            future.cancel()
+            future.add_done_callback(_closeResponse)
+        executor.shutdown(wait=False)
+
+    if winner is not None:
+        for r in responses:
+            r.close()
+        return winner
+
+    # Raise connection errors if no url could be reached at all
+    if not responses and error is not None:
+        raise error
+    last = responses.pop() if responses else None
+    for r in responses:
+        r.close()
+    return None, last
+
+
+def learnLayout(paper, layout, path=None):
+    """Remembers the url layout that worked for an examination session
+
+    Args:
+        paper(dict): paper details
+        layout(str): key of URL_LAYOUTS
+        path: the file to save the layouts in
+
+    Returns:
+        None
+    """
+
+    key = paper["year"] + "/" + paper["month"].capitalize()
+    layouts = loadLayouts(path)
+    with _layouts_lock:
+        if layouts.get(key) == layout:
+            return
+        layouts[key] = layout
+        saveLayouts(layouts, path)
+
+
+def loadLayouts(path=None):
+    """Loads the url layouts learned for each examination session
+
+    Args:
+        path: the file the layouts are saved in
+
+    Returns:
+        dict: layout key for each session, e.g. {"2016/May": "group4"}
+    """
+
+    global _layouts
+
+    if path == None:
+        path = LAYOUT_FILE
 
+    with _layouts_lock:
+        if _layouts is None:
+            try:
+                with open(path) as layoutfile:
+                    _layouts = json.load(layoutfile)
+            except (OSError, ValueError):
+                _layouts = {}
+        return _layouts
 
+
+@profiler.profiled("decode")
+def pageFound(r):
+    """Checks whether a web request found the page
+
+    The website does not return a 404 status code for missing papers
+    but an error page instead. Only HTML pages are read to look for it,
+    so the papers themselves are never decoded as text.
+
+    Args:
+        r(web request)
+
+    Returns:
+        bool
+    """
+
+    if r.status_code == 404:
+        return False
+    if "html" not in r.headers.get("Content-Type", ""):
+        return True
+    return r.text.find('Error 404 - Page Not Found') == -1
+
+
+@profiler.profiled("names")
 def paperNameGen(paper):
     """Generates pdf name
     
@@ -199,6 +549,21 @@ def paperNameGen(paper):
     return name
 
 
+def paperPathGen(paper):
+    """Generates the path of a paper within the LEVEL/YEAR/MONTH folders
+
+    Args:
+        paper(dict): paper details
+
+    Returns:
+        string: e.g. SL/2021/MAY/Physics_SL_M21_TZ1_qp1.pdf
+    """
+
+    return "/".join([paper["level"].upper(), paper["year"],
+                     paper["month"].upper(), paperNameGen(paper)])
+
+
+@profiler.profiled("rename")
 def renamePYP(paper, path=None):
     """Rename downloaded past year paper
     
@@ -255,6 +620,29 @@ def renamePYP(paper, path=None):
         return 1
 
 
+def saveLayouts(layouts, path=None):
+    """Saves the url layouts learned for each examination session
+
+    Args:
+        layouts(dict): layout key for each session
+        path: the file to save the layouts in
+
+    Returns:
+        int
+    """
+
+    if path == None:
+        path = LAYOUT_FILE
+
+    try:
+        with open(path, "w") as layoutfile:
+            json.dump(layouts, layoutfile, indent=4, sort_keys=True)
+    except OSError as error:
+        print(error)
+        return 1
+    return 0
+
+
 def sanity_check(paper):
     """Checks the paper details for any inconsistencies
 
@@ -307,6 +695,45 @@ def sanity_check(paper):
     # since there is only one timezone
 
 
+def urlGen(paper, pname):
+    """Generates candidate urls of a past year paper, best guess first
+
+    The layout learned for the examination session comes first, followed
+    by the layouts known to be used by the website.
+
+    Args:
+        paper(dict): paper details
+        pname(str): the name of the paper used by the website
+
+    Returns:
+        list of (layout, url) tuples
+    """
+
+    year = paper["year"]
+    month = paper["month"].capitalize()  # May or Nov
+    fullmonth = "November" if month == "Nov" else month
+
+    order = list(URL_LAYOUTS)
+
+    # May 2016 papers are known to be stored under Group 4
+    if (month == 'May' and year == '2016'):
+        order.remove("group4")
+        order.insert(0, "group4")
+
+    learned = loadLayouts().get(year + "/" + month)
+    if learned in URL_LAYOUTS:
+        order.remove(learned)
+        order.insert(0, learned)
+
+    urls = []
+    for layout in order:
+        folder = URL_LAYOUTS[layout].format(year=year, month=month,
+                                            fullmonth=fullmonth)
+        urls.append((layout, URL_ROOT + folder + pname))
+    return urls
+
+
+@profiler.profiled("names")
 def webNameGen(paper):
     """Generates pdf name given by website from past year paper details
     
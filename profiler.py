@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# Filename: profiler.py
+
+"""Profiling of the download pipeline of downloader.py and downloader_gui.py
+
+Each stage of the pipeline (e.g. reading the csv file, requesting the
+papers or writing them to disk) is wrapped with cProfile and tracemalloc
+when profiling is switched on. Nothing is recorded otherwise.
+
+Profiling is switched on with the --profile option, e.g.
+    python downloader.py --profile report
+    python downloader_gui.py --profile report
+
+Two reports can then be compared with
+    python profiler.py old_report new_report
+"""
+
+
+# Standard library modules
+from contextlib import contextmanager
+from functools import wraps
+import cProfile
+import json
+import os
+import os.path
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+
+# Number of functions and allocation sites listed for each stage
+TOP_ENTRIES = 20
+
+# Number of calls of each stage to take allocation snapshots for
+SNAPSHOT_CALLS = 3
+
+# Directory to write the report to. Profiling is off while this is None.
+_report_dir = None
+
+# Totals for each stage, by stage name
+_stages = {}
+
+# Stages currently running, innermost last
+_stack = []
+
+# Stages are recorded one thread at a time
+_lock = threading.RLock()
+
+# Allocations made by the profiling itself are left out of the report
+_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, "*/contextlib.py"),
+]
+
+
+def enable(report_dir):
+    """Switches profiling on
+
+    Args:
+        report_dir: the directory to write the report to
+
+    Returns:
+        None
+    """
+
+    global _report_dir
+
+    _report_dir = report_dir
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def enabled():
+    """Checks whether profiling is switched on
+
+    Returns:
+        bool
+    """
+
+    return _report_dir is not None
+
+
+@contextmanager
+def stage(name):
+    """Profiles the code run inside the with block as a pipeline stage
+
+    Stages may be nested. The time spent in an inner stage is counted in
+    the time and memory of the outer stage, but not in its cProfile stats.
+    The time taken to set up and tear down the inner stage is left out.
+
+    Allocation sites are taken from tracemalloc snapshots, which are slow,
+    so they are only sampled for the first SNAPSHOT_CALLS calls of each
+    stage that is not nested in another stage.
+
+    Args:
+        name(str): the name of the stage, e.g. csv2dict
+    """
+
+    if _report_dir is None:
+        yield
+        return
+
+    entered = time.perf_counter()
+    with _lock:
+        if name not in _stages:
+            _stages[name] = {
+                "profile": cProfile.Profile(),
+                "calls": 0,
+                "time": 0.0,
+                "peak": 0,
+                "allocated": 0,
+                "snapshots": 0,
+                "allocations": {},
+            }
+        totals = _stages[name]
+        parent = _stack[-1] if _stack else None
+
+        # Only one profile can be running at a time, so pause the outer one
+        if parent is not None:
+            parent["profile"].disable()
+
+        snapshot = None
+        if parent is None and totals["snapshots"] < SNAPSHOT_CALLS:
+            totals["snapshots"] += 1
+            snapshot = _snapshot()
+
+        frame = {
+            "profile": totals["profile"],
+            "current": tracemalloc.get_traced_memory()[0],
+            "peak": 0,
+            "overhead": 0.0,
+        }
+        _stack.append(frame)
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        frame["profile"].enable()
+        try:
+            yield
+        finally:
+            frame["profile"].disable()
+            end = time.perf_counter()
+            _stack.pop()
+
+            # Pass the peak on to the outer stage, as its peak was reset
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(frame["peak"], peak)
+
+            totals["calls"] += 1
+            totals["time"] += end - start - frame["overhead"]
+            totals["peak"] = max(totals["peak"], peak - frame["current"])
+            totals["allocated"] += max(current - frame["current"], 0)
+
+            if snapshot is not None:
+                stats = _snapshot().compare_to(snapshot, "lineno")
+                del snapshot
+                for stat in stats:
+                    if stat.size_diff <= 0:
+                        continue
+                    site = str(stat.traceback)
+                    size, count = totals["allocations"].get(site, (0, 0))
+                    totals["allocations"][site] = (size + stat.size_diff,
+                                                   count + stat.count_diff)
+
+            if parent is not None:
+                parent["peak"] = max(parent["peak"], peak)
+                parent["profile"].enable()
+                # Leave the set up and tear down of this stage, and of the
+                # stages nested in it, out of the time of the outer stage
+                parent["overhead"] += (frame["overhead"] + (start - entered)
+                                       + (time.perf_counter() - end))
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces(_FILTERS)
+
+
+def profiled(name):
+    """Decorator to profile every call of a function as a pipeline stage
+
+    Args:
+        name(str): the name of the stage, e.g. csv2dict
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _report_dir is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dump(report_dir=None):
+    """Writes the profile of each stage to the report directory
+
+    For each stage, the following files are written:
+    1. STAGE.prof -- the cProfile stats, to be read with pstats
+    2. STAGE.txt -- the functions with the highest cumulative time
+    3. STAGE_allocations.txt -- the sites that allocated the most memory,
+                                sampled as described in stage()
+    A summary.json of all stages is also written, to be used by compare().
+
+    Args:
+        report_dir: the directory to write the report to.
+                    Defaults to the one given to enable().
+
+    Returns:
+        int
+    """
+
+    if report_dir == None:
+        report_dir = _report_dir
+    if report_dir == None:
+        return 1
+
+    if not os.path.isdir(report_dir):
+        try:
+            os.makedirs(report_dir)
+        except OSError as error:
+            print(error)
+            return 1
+
+    summary = {}
+    with _lock:
+        for name, totals in _stages.items():
+            path = os.path.join(report_dir, name)
+
+            totals["profile"].dump_stats(path + ".prof")
+            with open(path + ".txt", "w") as statsfile:
+                stats = pstats.Stats(totals["profile"], stream=statsfile)
+                stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+
+            sites = sorted(totals["allocations"].items(),
+                           key=lambda item: item[1][0], reverse=True)
+            sites = sites[:TOP_ENTRIES]
+            with open(path + "_allocations.txt", "w") as allocfile:
+                for site, (size, count) in sites:
+                    allocfile.write("{}: {:.1f} KiB in {} blocks\n".format(
+                        site, size / 1024, count))
+
+            summary[name] = {
+                "calls": totals["calls"],
+                "time": totals["time"],
+                "peak": totals["peak"],
+                "allocated": totals["allocated"],
+                "top_allocations": [[site, size] for site, (size, count)
+                                    in sites],
+            }
+
+    with open(os.path.join(report_dir, "summary.json"), "w") as summaryfile:
+        json.dump(summary, summaryfile, indent=4, sort_keys=True)
+
+    return 0
+
+
+def compare(old_dir, new_dir):
+    """Compares the summaries of two reports written by dump()
+
+    Args:
+        old_dir: the directory of the report before a change
+        new_dir: the directory of the report after a change
+
+    Returns:
+        string
+    """
+
+    summaries = []
+    for report_dir in [old_dir, new_dir]:
+        with open(os.path.join(report_dir, "summary.json")) as summaryfile:
+            summaries.append(json.load(summaryfile))
+    old, new = summaries
+
+    def change(before, after):
+        if not before:
+            return "n/a"
+        return "{:+.1f}%".format((after - before) / before * 100)
+
+    empty = {"calls": 0, "time": 0.0, "peak": 0, "allocated": 0}
+
+    lines = ["{:<10} {:>7} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+        "stage", "calls", "old time", "new time", "change",
+        "old peak", "new peak", "change")]
+    for name in sorted(set(old) | set(new)):
+        before = old.get(name, empty)
+        after = new.get(name, empty)
+        lines.append(
+            "{:<10} {:>7} {:>9.3f}s {:>9.3f}s {:>8} {:>7.1f}KiB {:>7.1f}KiB {:>8}"
+            .format(name, after["calls"], before["time"], after["time"],
+                    change(before["time"], after["time"]),
+                    before["peak"] / 1024, after["peak"] / 1024,
+                    change(before["peak"], after["peak"])))
+
+    return "\n".join(lines)
+
+
+def main():
+    """Main function"""
+    if len(sys.argv) != 3:
+        print("Usage: python profiler.py old_report new_report")
+        return 1
+    print(compare(sys.argv[1], sys.argv[2]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())